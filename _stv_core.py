@@ -0,0 +1,115 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the same loops run (slowly) as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# -- Counting kernels operating on the ballots of ElectionManager
+# Each ballot is a row of order: candidate indices in order of preference, padded with -1 once exhausted.
+# cursor holds the position in order of the candidate each ballot is currently going to.
+@njit(cache=True)
+def advance_cursor(order, cursor, remaining_mask):
+    """Move every ballot on to its most preferred remaining candidate, in place
+
+    :param order: Candidate indices of each ballot in order of preference, -1 once exhausted
+    :type order: np.ndarray
+    :param cursor: Position in order of the candidate each ballot is going to, modified in place
+    :type cursor: np.ndarray
+    :param remaining_mask: True for candidates still in the count
+    :type remaining_mask: np.ndarray
+    """
+    for voter in range(order.shape[0]):
+        position = cursor[voter]
+        while order[voter, position] != -1 and not remaining_mask[order[voter, position]]:
+            position += 1
+        cursor[voter] = position
+
+
+@njit(cache=True)
+def compute_totals(order, cursor, values, n_cands):
+    """Find how many votes each candidate is receiving, taking into account the value of the votes
+
+    :param order: Candidate indices of each ballot in order of preference, -1 once exhausted
+    :type order: np.ndarray
+    :param cursor: Position in order of the candidate each ballot is going to
+    :type cursor: np.ndarray
+    :param values: Value of each vote
+    :type values: np.ndarray
+    :param n_cands: Number of candidates
+    :type n_cands: int
+    :return: Total for every candidate, zero for those not remaining
+    :rtype: np.ndarray
+    """
+    totals = np.zeros(n_cands)
+    for voter in range(order.shape[0]):
+        candidate = order[voter, cursor[voter]]
+        if candidate != -1:
+            totals[candidate] += values[voter]
+    return totals
+
+
+@njit(cache=True)
+def apply_transfer(order, cursor, values, winner_idx, transfer_value):
+    """Decrease the value of the votes going to a winner, in place
+
+    :param order: Candidate indices of each ballot in order of preference, -1 once exhausted
+    :type order: np.ndarray
+    :param cursor: Position in order of the candidate each ballot is going to
+    :type cursor: np.ndarray
+    :param values: Value of each vote, modified in place
+    :type values: np.ndarray
+    :param winner_idx: Index of the winning candidate
+    :type winner_idx: int
+    :param transfer_value: Multiplier for the winner's votes
+    :type transfer_value: float
+    """
+    for voter in range(order.shape[0]):
+        if order[voter, cursor[voter]] == winner_idx:
+            values[voter] *= transfer_value
+
+
+@njit(cache=True)
+def count_round(order, cursor, values, remaining_mask, quota):
+    """Count a round, then find the winners and the lowest candidates in a single pass over the totals
+
+    :param order: Candidate indices of each ballot in order of preference, -1 once exhausted
+    :type order: np.ndarray
+    :param cursor: Position in order of the candidate each ballot is going to
+    :type cursor: np.ndarray
+    :param values: Value of each vote
+    :type values: np.ndarray
+    :param remaining_mask: True for candidates still in the count
+    :type remaining_mask: np.ndarray
+    :param quota: Minimum total required to win
+    :type quota: float
+    :return: totals (nan for those not remaining), indices of candidates reaching the quota,
+        indices of candidates with the lowest total
+    :rtype: Tuple
+    """
+    n_cands = remaining_mask.shape[0]
+    totals = compute_totals(order, cursor, values, n_cands)
+    winning = np.empty(n_cands, dtype=np.int64)
+    lowest = np.empty(n_cands, dtype=np.int64)
+    n_winning = 0
+    n_lowest = 0
+    lowest_total = np.inf
+    for candidate in range(n_cands):
+        if not remaining_mask[candidate]:
+            totals[candidate] = np.nan
+            continue
+        total = totals[candidate]
+        if total >= quota:
+            winning[n_winning] = candidate
+            n_winning += 1
+        if total < lowest_total:
+            lowest_total = total
+            n_lowest = 0
+        if total == lowest_total:
+            lowest[n_lowest] = candidate
+            n_lowest += 1
+    return totals, winning[:n_winning], lowest[:n_lowest]
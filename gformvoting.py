@@ -2,8 +2,8 @@ import argparse
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+from _stv_core import advance_cursor, apply_transfer, count_round
 
 
 # -- Loading and preparation of a .csv
@@ -16,10 +16,11 @@ def load_voting(filepath):
     :return: mastertable, roles, candidates
     :rtype: pd.DataFrame, list, list
     """
-    mastertable = pd.read_csv(filepath)
+    # Only parse the vote columns, found from the header alone
+    vote_columns = remove_non_vote_columns(pd.read_csv(filepath, nrows=0)).keys()
+    mastertable = pd.read_csv(filepath, usecols=vote_columns, dtype=str)  # a column nobody voted in would be float
 
-    mastertable = remove_non_vote_columns(mastertable)
-    mastertable = mastertable.applymap(voting_value_to_num)
+    mastertable = votes_to_num(mastertable)
 
     roles, candidates = find_roles_and_candidates(mastertable)
     return mastertable, roles, candidates
@@ -38,35 +39,48 @@ def remove_non_vote_columns(mastertable):
     return mastertable.drop(columns=killcolumns)
 
 
-def voting_value_to_num(contents):
-    """Convert the form's P1/P2/P3... into integers.
-    If a column contains a vote where no preference was specified, then the votes will be in float form
-    since pandas can't put nans into integer type columns.
+def votes_to_num(mastertable):
+    """Convert the form's P1/P2/P3... into small integers.
+    Cells where no preference was specified become <NA>, using pandas' nullable integer type
+    so the columns don't have to be stored as float.
 
-    :param contents:
-    :type contents: a value from a cell
-    :return: Value representing the vote, no preference is a zero
-    :rtype: int or np.nan
+    :param mastertable: Table of vote columns, as strings
+    :type mastertable: pd.DataFrame
+    :return: Table with the same columns, values representing the vote
+    :rtype: pd.DataFrame
     """
-    if not isinstance(contents, str):
-        return np.nan
-    else:
-        return int(contents[1:])
+    for col in mastertable.keys():
+        mastertable[col] = pd.to_numeric(mastertable[col].str.slice(1), errors='coerce')  # Strip the leading 'P'
+    mastertable = mastertable.astype('Int16')
+    return mastertable
 
 
-def split_columnname(columnname):
-    """Find the role and the name of a candidate from the column header
+def split_columnnames(mastertable):
+    """Find the role and the name of the candidate from every column header
     The form's header format should be like:
     Albert Einstein [Sports Representative]
 
-    :param columnname: Name of the column as direct from the Form
-    :type columnname: str
-    :return: role, name
+    :param mastertable: Table with the column names as direct from the Form
+    :type mastertable: pd.DataFrame
+    :return: Table indexed by column name with columns of role and name
+    :rtype: pd.DataFrame
+    """
+    columnnames = pd.Series(mastertable.keys(), index=mastertable.keys())
+    return columnnames.str.extract(r'^(?P<role>.*?) \[(?P<name>.*)\]$')
+
+
+def index_columns(mastertable):
+    """Build the lookups used to pull out the table for a single role
+
+    :param mastertable:
+    :type mastertable: pd.DataFrame
+    :return: role -> list of its column names, column name -> candidate name
     :rtype: Tuple
     """
-    role, name = columnname.split(' [')
-    name = name[:-1]  # Remove the final ']'
-    return role, name
+    columnnames = split_columnnames(mastertable)
+    role_columns = {role: columns.tolist() for role, columns in columnnames.groupby('role', sort=False).groups.items()}
+    candidate_names = columnnames['name'].to_dict()
+    return role_columns, candidate_names
 
 
 def find_roles_and_candidates(mastertable):
@@ -77,20 +91,14 @@ def find_roles_and_candidates(mastertable):
     :return: lists of roles, names
     :rtype: Tuple
     """
-    roles = []
-    names = []
-    for col in mastertable.keys():
-        role, name = split_columnname(col)
-        if role not in roles:
-            roles.append(role)
-        if name not in names:
-            names.append(name)
-    names.sort()
+    columnnames = split_columnnames(mastertable)
+    roles = columnnames['role'].drop_duplicates().tolist()
+    names = sorted(columnnames['name'].unique().tolist())
     return roles, names
 
 
 # -- Prepare the counting for a single role/seat in the election
-def retrieve_role_voting_table(mastertable, rolename):
+def retrieve_role_voting_table(mastertable, rolename, column_index=None):
     """Extract a table relating to a single role
     Columns are renamed to the name of the candidate
 
@@ -98,14 +106,17 @@ def retrieve_role_voting_table(mastertable, rolename):
     :type mastertable: pd.DataFrame
     :param rolename: Name of role
     :type rolename: str
+    :param column_index: Output of index_columns(mastertable), built here if not given
+    :type column_index: Tuple
     :return: Table with only the columns for a particular role, with the columns renamed to the candidate name.
     :rtype: pd.DataFrame
     """
-    election_columns = [rolename == split_columnname(columnname)[0] for columnname in mastertable.keys()]
-    assert sum(election_columns) > 0, f"{rolename} not found as a role in the master table."
-    voting_table = mastertable.loc[:, election_columns]
-    voting_table = voting_table.rename(
-        columns=dict([(colname, split_columnname(colname)[1]) for colname in voting_table.keys()]))
+    if column_index is None:
+        column_index = index_columns(mastertable)
+    role_columns, candidate_names = column_index
+    assert rolename in role_columns, f"{rolename} not found as a role in the master table."
+    voting_table = mastertable.loc[:, role_columns[rolename]]
+    voting_table = voting_table.rename(columns=candidate_names)
     return voting_table
 
 
@@ -117,16 +128,13 @@ def discard_informal_votes(voting_table):
     :return: A possibly shorter len() table
     :rtype: pd.DataFrame
     """
-    invalids = []
-    for index, vote in voting_table.iterrows():
-        no_vote = [np.isnan(pref) for pref in vote]
-        if all(no_vote):
-            invalids.append(index)
-            continue
-        no_first_pref = not any(vote == 1)
-        not_sequential = not all([sum(vote.isin([float(pref)])) == 1 for pref in range(1, int(vote.max()) + 1)])
-        if no_first_pref or not_sequential:
-            invalids.append(index)
+    votes = voting_table.to_numpy(dtype=float, na_value=np.nan)
+    n_prefs = (~np.isnan(votes)).sum(axis=1)
+    # A formal vote has preferences 1, 2, ... n_prefs each exactly once, sorting puts the nans last
+    in_sequence = np.sort(votes, axis=1) == np.arange(1, votes.shape[1] + 1)
+    given = np.arange(votes.shape[1]) < n_prefs[:, None]
+    formal = (n_prefs > 0) & (in_sequence | ~given).all(axis=1)
+    invalids = voting_table.index[~formal]
     print(f"Removed {len(invalids)} informal votes of {len(voting_table)}.")
     return voting_table.drop(invalids)
 
@@ -146,19 +154,6 @@ def remove_excluded_candidates(voting_table, excluded):
     voting_table = voting_table.drop(columns=excluded)
     return voting_table
 
-def find_lowest_candidates(resulttable):
-    """Find the candidates with the lowest total
-
-    :param resulttable: Output of a ElectionManager.calculate_total, columns of Candidate and Total
-    :type resulttable: pd.DataFrame
-    :return: List of names of the candidates with the lowest score
-    :rtype: list
-    """
-    mintotal = resulttable.Total.min()
-    lowest = resulttable.Total == mintotal
-    candidates = resulttable.loc[lowest, 'Candidate'].values.tolist()
-    return candidates
-
 
 class ElectionManager:
     def __init__(self, votetable, n_winners=1, doplot=False):
@@ -171,88 +166,107 @@ class ElectionManager:
         :param doplot: Plot a bar chart showing result for each round
         :type doplot: bool or plt.Axes
         """
-        self.votes = [Vote(row) for index, row in votetable.iterrows()]
+        # Ballots are stored as one preference matrix rather than one object per vote, no preference is a zero
+        self.prefs = votetable.to_numpy(dtype=np.int16, na_value=0)
+        self.values = np.ones(len(votetable))  # This can change if the vote is transferred following a surplus
+        self.cand_idx = {candidate: i for i, candidate in enumerate(votetable.keys())}
+        self.candidate_dtype = pd.CategoricalDtype(votetable.keys())  # Candidate columns compare by integer code
+
+        # Rank of each candidate on each ballot (1st preference is 0), -1 where no preference was given
+        ranked_prefs = np.where(self.prefs == 0, np.iinfo(np.int16).max, self.prefs)
+        order = ranked_prefs.argsort(axis=1)  # Candidates in order of preference
+        self.ranks = np.empty(self.prefs.shape, dtype=np.int16)
+        np.put_along_axis(self.ranks, order, np.arange(self.prefs.shape[1], dtype=np.int16), axis=1)
+        self.ranks[self.prefs == 0] = -1
+
+        # Candidates of each ballot in order of preference, padded with -1 so every ballot ends exhausted
+        n_prefs = (self.prefs != 0).sum(axis=1)
+        self.order = np.full((len(self.prefs), n_prefs.max(initial=0) + 1), -1, dtype=np.int16)
+        given = np.arange(self.order.shape[1] - 1) < n_prefs[:, None]
+        self.order[:, :-1][given] = order[:, :self.order.shape[1] - 1][given]
+        self.cursor = np.zeros(len(self.prefs), dtype=np.int32)  # Position in order of who each ballot goes to
 
         self.n_winners = n_winners
         self.quota = np.floor(len(votetable) / (n_winners + 1)) + 1  # minimum number of votes required to win
 
         self.candidates = votetable.keys().to_list()
-        self.remaining_candidates = votetable.keys().to_list()
+        self.remaining_mask = np.ones(len(self.candidates), dtype=bool)  # False once elected or eliminated
         self.winning_candidates = []
-        self.result_record = []
+        self.totals_by_round = {}  # Round -> total of every candidate, nan once elected or eliminated
 
         self.allow_random_tiebreak = False
         self.verbose = True
         self.doplot = doplot
 
+    @property
+    def remaining_candidates(self):
+        """Candidates that haven't been elected or eliminated yet"""
+        return [candidate for candidate, remaining in zip(self.candidates, self.remaining_mask) if remaining]
+
     def run(self):
         print(f"Running election with candidates {self.candidates}")
-        for round in range(1, len(self.candidates) + 1):
+        round = 0
+        while self.remaining_mask.any():  # Batch eliminations can use fewer rounds than there are candidates
+            round += 1
             print(f"Round {round}")
-            result = self.calculate_total(self.remaining_candidates)
-            result['Round'] = round
-            self.result_record.append(result)
-
-            winning = result.Total >= self.quota
-            if any(winning):
-                winning_candidates = result.loc[winning, 'Candidate'].values
-                [self.winning_candidates.append(candidate) for candidate in winning_candidates]
+            totals, winning, lowest = count_round(self.order, self.cursor, self.values, self.remaining_mask, self.quota)
+            self.totals_by_round[round] = totals
+
+            if len(winning) > 0:
+                self.winning_candidates.extend(self.candidates[idx] for idx in winning)
                 if len(self.winning_candidates) == self.n_winners:
                     break
                 elif len(self.winning_candidates) < self.n_winners:
                     # If the required number of winners haven't been found, we'll have to transfer
-                    for candidate in winning_candidates:
-                        total_value = result.loc[result.Candidate == candidate, 'Total'].value
+                    for winner_idx in winning:
+                        total_value = totals[winner_idx]
                         surplus_votes = total_value - self.quota
                         transfer_value = surplus_votes / total_value
-                        for vote in self.votes:
-                            if vote.voting_for(self.remaining_candidates) == candidate:
-                                vote.value = vote.value * transfer_value
-                    [self.remaining_candidates.remove(candidate) for candidate in winning_candidates]
+                        apply_transfer(self.order, self.cursor, self.values, winner_idx, transfer_value)
+                    self.remaining_mask[winning] = False
+                    advance_cursor(self.order, self.cursor, self.remaining_mask)  # Tiebreaks see the transferred votes
                 else:
                     raise AssertionError("More winners than allowed, this should be impossible.")
 
-            eliminated_candidate_list = find_lowest_candidates(result)
-            if len(eliminated_candidate_list) > 1:
+            eliminated_candidate_list = [self.candidates[idx] for idx in lowest]
+            if len(winning) == 0 and 1 < len(lowest) < self.remaining_mask.sum() and totals[lowest[0]] == 0:
+                # Candidates without votes have nothing to transfer, and with no winner or other elimination in
+                # between nothing can be transferred to them either, so they can all be eliminated at once
+                eliminated_candidates = eliminated_candidate_list
+            elif len(eliminated_candidate_list) > 1:
                 print('Tiebreak initiated!')
-                eliminated_candidate = self.tiebreak(eliminated_candidate_list)
+                eliminated_candidates = [self.tiebreak(eliminated_candidate_list)]
             elif len(eliminated_candidate_list) == 0:
                 raise AssertionError("This shouldn't be possible")
             else:
-                eliminated_candidate = eliminated_candidate_list[0]
-            self.remaining_candidates.remove(eliminated_candidate)
-            if self.verbose:
-                print(f"{eliminated_candidate} eliminated.")
+                eliminated_candidates = eliminated_candidate_list
+            for eliminated_candidate in eliminated_candidates:
+                self.remaining_mask[self.cand_idx[eliminated_candidate]] = False
+                if self.verbose:
+                    print(f"{eliminated_candidate} eliminated.")
+            advance_cursor(self.order, self.cursor, self.remaining_mask)
 
         print(f"Winners: {', '.join(self.winning_candidates)}")
         if self.doplot:
-            result_record = pd.concat(self.result_record)
+            import matplotlib.pyplot as plt  # Plotting libraries are only imported when needed, they're slow to load
+            import seaborn as sns
             ax = plt.gca()
-            sns.barplot(ax=ax, data=result_record, x='Round', y='Total', hue='Candidate')
+            sns.barplot(ax=ax, data=self.result_record(), x='Round', y='Total', hue='Candidate')
             ax.axhline(self.quota, c='r', ls='--')
             ax.legend(loc=(1.01, 0))
 
-    def calculate_total(self, candidates):
-        """Find how many votes each candidate in candidates is receiving.
-        This takes into account the value of the vote (which can decrease in STV)
+    def result_record(self):
+        """Results of every round so far
 
-        :param candidates: List of candidates to find a total for
-        :type candidates: list
-        :return: Table with columns candidate and total, of len() len(candidates)
+        :return: Table with columns Candidate, Total and Round
         :rtype: pd.DataFrame
         """
-        vote_table = []
-        for vote in self.votes:
-            vote_table.append({'Candidate': vote.voting_for(candidates),
-                               'Value': vote.value})  # value can be lower than one if it's been transferred from winner
-        vote_table = pd.DataFrame(vote_table)
-
-        result = []
-        for candidate in candidates:
-            result.append({'Candidate': candidate,
-                           'Total': vote_table.loc[vote_table.Candidate == candidate, 'Value'].sum()})
-        result = pd.DataFrame(result)
-        return result
+        rounds = list(self.totals_by_round)
+        result_record = pd.DataFrame({
+            'Candidate': pd.Categorical(np.tile(self.candidates, len(rounds)), dtype=self.candidate_dtype),
+            'Total': np.concatenate([self.totals_by_round[round] for round in rounds]) if rounds else [],
+            'Round': np.repeat(rounds, len(self.candidates))})
+        return result_record.dropna(subset=['Total']).reset_index(drop=True)
 
     def tiebreak(self, tied_candidates):
         """Use tiebreak algorithm to find candidate to eliminate.
@@ -271,17 +285,14 @@ class ElectionManager:
 
     def backwards_tiebreak(self, tied_candidates):
         """Break tie by looking to previous rounds for the difference"""
-        result_record = pd.concat(self.result_record)
-        result_record = result_record.loc[result_record['Candidate'].isin(tied_candidates)]  # Only tied_candidates
-        for round in np.sort(result_record['Round'].unique())[::-1]:  # Iterate from most recent to first round
-            result = result_record.loc[result_record['Round'] == round, :]
-            eliminated = find_lowest_candidates(result)
+        tied_idx = [self.cand_idx[candidate] for candidate in tied_candidates]
+        for round in sorted(self.totals_by_round, reverse=True):  # Iterate from most recent to first round
+            totals = self.totals_by_round[round][tied_idx]  # Only tied_candidates
+            eliminated = np.flatnonzero(totals == totals.min())
             if len(eliminated) == 1:
                 if self.verbose:
                     print(f"\tLookback tiebreak finds difference at round {round}")
-                return eliminated[0]
-            else:
-                continue
+                return tied_candidates[eliminated[0]]
         if self.verbose:
             print("\tBackwards tiebreak failed.")
         return None
@@ -296,79 +307,43 @@ class ElectionManager:
         """
 
         # Find the votes that are involved in the tie in the current round
-        active_votes = [vote for vote in self.votes if vote.voting_for(self.remaining_candidates) in tied_candidates]
-        result_record = []
+        tied_idx = [self.cand_idx[candidate] for candidate in tied_candidates]
+        voting_for = np.take_along_axis(self.order, self.cursor[:, None], axis=1)[:, 0]
+        active_votes = np.isin(voting_for, tied_idx)
+        ranks = self.ranks[active_votes][:, tied_idx]  # Only our candidates of interest
+        values = self.values[active_votes]
         for pref in range(1, len(self.candidates)):  # Maximum preference # is len(candidates)
-            votetable = []
-            # Build a table of raw preferences (i.e. without transfer)
-            for vote in active_votes:
-                votetable.append({'Candidate': vote.voting_for(self.candidates,
-                                                               preference=pref),  # For this level of preference
-                                  'Value': vote.value})
-            votetable = pd.DataFrame(votetable)
-
-            # Find the results for our candidates of interest
-            result = pd.DataFrame([{'Candidate': candidate,
-                                    'Total': votetable.loc[votetable.Candidate == candidate, 'Value'].sum()}
-                                   for candidate in tied_candidates])
-            result['Preference'] = pref
-            result_record.append(result)
-            mintotal = result.Total.min()
-            lowest = result.Total == mintotal
+            # Raw preferences (i.e. without transfer) for this level of preference
+            totals = values @ (ranks == pref - 1)
+            lowest = totals == totals.min()
             if sum(lowest) == 1:
-                result_record = pd.concat(result_record)
-                if self.verbose:
-                    print(f"\tPreference tiebreaker finds difference at preference level: {pref}")
-                return result.loc[lowest, 'Candidate'].item()
-        result_record = pd.concat(result_record)
+                break
+        lowest_candidates = np.array(tied_candidates)[lowest]
+        if len(lowest_candidates) == 1:
+            if self.verbose:
+                print(f"\tPreference tiebreaker finds difference at preference level: {pref}")
+            return lowest_candidates.item()
         if self.allow_random_tiebreak:
             print("Holy moly! It's a tie all the way down, initiating a random tiebreak!")
-            return np.random.choice(result.loc[lowest, 'Candidate'].values)
+            return np.random.choice(lowest_candidates)
         else:
             raise AssertionError(f"We've got a total tie and random solutions aren't allowed!")
 
 
-class Vote:
-    def __init__(self, voterow):
-        """A single vote
-
-        :param voterow: A row from retrieve_role_voting_table()
-        :type voterow: pd.Series
-        """
-        self.vote = voterow
-        self.value = 1  # This can change if the vote is transferred following a surplus
-
-    def voting_for(self, valid_candidates, preference=1):
-        """Given a list of candidates, which one does this vote go to?
-
-        :param valid_candidates: List of candidates that the vote could go to
-        :type valid_candidates: list
-        :param preference: Which preference to find
-        :type preference: int
-        :return: Name of candidate that the vote is going to
-        :rtype: str
-        """
-        active_vote = self.vote[valid_candidates]
-        active_vote = active_vote.loc[~active_vote.isna()]  # remove nans
-        pointing_to = active_vote.argsort().argsort()  # raw preferences into ranked list
-        requested_preference = pointing_to == (preference - 1)  # 1st preference is sorted to 0
-        if sum(requested_preference) == 0:
-            return None
-        return pointing_to.keys()[requested_preference].item()
-
-
 def main(filepath, show_plot=False):
     master_voting_table, roles, names = load_voting(filepath)
     print(f"Unique roles found: {roles}")
     print(f"Unique candidates found: {names}")
 
     if show_plot:
+        import matplotlib.pyplot as plt
         plt.clf()
         grid = plt.GridSpec(len(roles), 2, width_ratios=[6, 1])
+    column_index = index_columns(master_voting_table)  # Shared by every role
     for xrole, role in enumerate(roles):
         print(" ")
         print(f"Role: {role}")
-        election_table = retrieve_role_voting_table(master_voting_table, role)
+        election_table = retrieve_role_voting_table(master_voting_table, role, column_index)
         manager = ElectionManager(election_table, doplot=plt.subplot(grid[xrole, 0]) if show_plot else show_plot)
         manager.run()
 